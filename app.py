@@ -1,27 +1,29 @@
-from fastapi import FastAPI, HTTPException, Query
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
 from route_engine import SafeRouter
 import uvicorn
 import os
 
-app = FastAPI(title="Pregnancy Safe Route API")
-
-# Global router instance
-router = None
-
-@app.on_event("startup")
-async def startup_event():
-    global router
+@asynccontextmanager
+async def lifespan(app: FastAPI):
     road_file = 'dataset/nepal_roads_full.gpkg'
     clinic_file = 'dataset/nepal_hospitals_full.geojson'
+    # Optional, built by build_cache.py; shared read-only by all workers
+    graph_dir = os.getenv('GRAPH_DIR', 'dataset/road_network')
     
+    app.state.router = None
     if os.path.exists(road_file) and os.path.exists(clinic_file):
         print("Initializing Routing Engine... (This may take a minute)")
-        router = SafeRouter(road_file, clinic_file)
+        app.state.router = SafeRouter(road_file, clinic_file, graph_dir)
         print("Routing Engine Ready!")
     else:
         print("Warning: Data files not found. Routing will fail.")
+    yield
+
+app = FastAPI(title="Pregnancy Safe Route API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 @app.get("/")
 async def read_index():
@@ -29,12 +31,13 @@ async def read_index():
 
 @app.get("/api/route")
 async def get_route(
+    request: Request,
     lat: float = Query(..., description="Start Latitude"),
     lon: float = Query(..., description="Start Longitude"),
     week: int = Query(None, description="Pregnancy Week"),
     mode: str = Query("routine", description="Routing Mode (routine/high_risk/emergency)")
 ):
-    global router
+    router = request.app.state.router
     if not router:
         raise HTTPException(status_code=503, detail="Routing engine not initialized")
     
@@ -46,7 +49,12 @@ async def get_route(
         
         # Log a snippet of the result
         print(f"Routes found: {len(results)}. Mode: {mode}")
-        return results
+        cache = router.route_cache_info()
+        # Returned directly so orjson serializes it without a jsonable_encoder pass
+        return ORJSONResponse(results, headers={
+            "X-Route-Cache-Hits": str(cache.hits),
+            "X-Route-Cache-Misses": str(cache.misses),
+        })
     except HTTPException:
         raise
     except Exception as e:
@@ -56,15 +64,19 @@ async def get_route(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/hospitals")
-async def get_hospitals():
-    global router
+async def get_hospitals(request: Request):
+    router = request.app.state.router
     if not router or router.clinics_gdf is None:
         raise HTTPException(status_code=503, detail="Hospitals not loaded")
     
-    return router.clinics_gdf.__geo_interface__
+    # Clinic attributes can include dates (e.g. OSM check_date) that orjson rejects
+    # as pandas Timestamps; jsonable_encoder writes them as ISO strings
+    return JSONResponse(jsonable_encoder(router.clinics_gdf.__geo_interface__))
 
 # Mount static files
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 if __name__ == "__main__":
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+    # DEV=1 enables auto-reload; WORKERS sets the process count for deployments
+    uvicorn.run("app:app", host="0.0.0.0", port=8000,
+                reload=os.getenv("DEV") == "1", workers=int(os.getenv("WORKERS", 1)))
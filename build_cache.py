@@ -1,5 +1,7 @@
 from route_engine import SafeRouter
 import time
+import os
+import sys
 
 def build_cache():
     print("Starting cache build process...")
@@ -8,10 +10,15 @@ def build_cache():
     # Files
     road_file = 'dataset/nepal_roads_full.gpkg'
     clinic_file = 'dataset/nepal_hospitals_full.geojson'
- # Dummy for init
+    graph_dir = os.getenv('GRAPH_DIR', 'dataset/road_network')
     
-    # Initialize router (triggers build_graph and pickle dump)
+    # Build the nationwide CSR graph and save it for app startup
     router = SafeRouter(road_file, clinic_file)
+    try:
+        router.build_graph_cache(graph_dir)
+    except RuntimeError as e:
+        print(f"Cache build failed: {e}")
+        sys.exit(1)
     
     end_time = time.time()
     print(f"Done! Cache built in {end_time - start_time:.2f} seconds.")
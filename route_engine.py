@@ -1,28 +1,80 @@
 import geopandas as gpd
-import networkx as nx
+import pandas as pd
+import numpy as np
 import math
 import os
-import pickle
 import logging
-from shapely.geometry import Point, LineString
+import shapely
+from functools import lru_cache
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra, connected_components
+from scipy.spatial import cKDTree
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class NoRouteError(Exception):
+    """Raised by SafeRouter._compute_route when no route can be produced; never cached."""
+
 class SafeRouter:
-    def __init__(self, road_file, clinic_file):
+    # Surface-tier penalties and candidate search radius (meters) per routing mode
+    MODE_PROFILES = {
+        "emergency": ({"smooth": 1.0, "moderate": 1.1, "rough": 1.3, "avoid": 2.5}, 10000),
+        "high_risk": ({"smooth": 1.0, "moderate": 1.2, "rough": 1.6, "avoid": 3.5}, 20000),
+        "routine": ({"smooth": 1.0, "moderate": 1.15, "rough": 1.4, "avoid": 3.0}, 50000),
+    }
+    # Search radius = farthest candidate * worst penalty * this factor (see get_safest_route)
+    SEARCH_DETOUR_FACTOR = 2.0
+    # Route results are cached on start coordinates rounded to this many decimals (~10 m)
+    ROUTE_CACHE_DECIMALS = 4
+    EARTH_RADIUS = 6371000.0  # meters, shared by the distance helpers
+    # Same sphere as the haversine so radius prefilters stay a superset of its matches
+    METERS_PER_DEGREE = math.radians(1) * EARTH_RADIUS
+    # bbox recorded for a graph built from the whole road file, so it is always reused
+    FULL_EXTENT = (-180.0, -90.0, 180.0, 90.0)
+
+    def __init__(self, road_file, clinic_file, graph_dir=None):
         """
         Initialize the SafeRouter with road network and clinic data.
+        graph_dir: optional directory of .npy arrays written by build_graph_cache;
+        when present the nationwide graph is memory-mapped from it instead of
+        built per region.
         """
         self.road_file = road_file
         self.clinic_file = clinic_file
-        self.G = None 
+        self.graph_dir = graph_dir
+        # Regional CSR graph (see _to_csr)
+        self.indptr = None
+        self.indices = None
+        self.w = None
+        self.s = None
+        self.node_xy = None
+        self.csr_by_mode = {} # mode -> csr_matrix of penalized edge costs
+        self.csr_edge = None # csr_matrix mapping (u, v) -> edge id into w/s
+        # Contracted search graph over the same node ids (see _contract_chains)
+        self.csr_chain = None # csr_matrix mapping search edge (u, v) -> chain id, -1 for an original edge
+        self.chain_pen_by_mode = {} # mode -> penalty per chain
+        self.chain_ptr = None
+        self.chain_nodes = None
+        self.chain_len = None
+        self.v_chain = None
+        self.v_pos = None
+        self.v_off = None
+        self.kdtree = None # cKDTree over node_xy (lon scaled, see _scale_xy) for nearest-node lookups
+        self.lon_scale = 1.0
+        # Per-clinic arrays aligned with clinics_gdf rows (see _index_clinics)
+        self.clinic_xy = None
+        self.clinic_idx = None
+        self.clinic_is_hosp = None
+        self.clinic_tree = None
+        self.clinic_node = None # nearest graph node per clinic, refreshed with the graph
+        self._route_cached = lru_cache(maxsize=4096)(self._compute_route)
         self.current_bbox = None # (minx, miny, maxx, maxy)
         
         logger.info(f"Nationwide Router initialized with {road_file}")
         try:
-            full_clinics = gpd.read_file(clinic_file)
+            full_clinics = gpd.read_file(clinic_file, engine="pyogrio")
             
             # Keywords strictly for pregnancy-related facilities
             pregnancy_keywords = [
@@ -77,47 +129,542 @@ class SafeRouter:
                 logger.info(f"Confirmed {dh_name} matches in filtered list: {dh_check['name'].tolist()}")
             else:
                 logger.warning(f"{dh_name} Hospital MISSING from filtered list!")
+            
+            self._index_clinics()
                 
         except Exception as e:
             logger.error(f"Failed to load clinics: {e}. Routing won't work.")
             self.clinics_gdf = None
 
+        if graph_dir and os.path.isdir(graph_dir):
+            self.load_graph_cache(graph_dir)
+
+    def _index_clinics(self):
+        """
+        Extracts clinic coordinates once so requests avoid iterrows, and builds
+        a cKDTree over them for radius queries. Facilities without a geometry are
+        dropped from clinics_gdf, since they cannot be located or routed to.
+        """
+        geom = self.clinics_gdf.geometry
+        located = ~(geom.isna() | geom.is_empty)
+        if not located.all():
+            logger.warning(f"Dropping {int((~located).sum())} facilities with missing or empty geometry")
+            self.clinics_gdf = self.clinics_gdf[located]
+        centroids = shapely.centroid(np.asarray(self.clinics_gdf.geometry.values))
+        self.clinic_xy = np.column_stack([shapely.get_x(centroids), shapely.get_y(centroids)])
+        self.clinic_idx = self.clinics_gdf.index.to_numpy()
+        amenity = self.clinics_gdf['amenity'] if 'amenity' in self.clinics_gdf else None
+        self.clinic_is_hosp = (amenity == 'hospital').to_numpy() if amenity is not None else np.zeros(len(self.clinics_gdf), dtype=bool)
+        self.clinic_tree = cKDTree(self.clinic_xy)
+
+    def build_graph_cache(self, graph_dir):
+        """
+        Builds the full road network and saves its CSR arrays to graph_dir, one .npy per array.
+        Raises RuntimeError, writing nothing, if check_contraction finds mismatches.
+        """
+        graph = self._build_regional_graph(None)
+        graph = dict(graph, **self._derived_arrays(graph))
+        self._set_graph(graph, self.FULL_EXTENT)
+        
+        # Shortcut edges must not change any road cost
+        mismatches = self.check_contraction()
+        if mismatches:
+            raise RuntimeError(f"Contracted graph disagrees with the full graph in {mismatches} searches; cache not written")
+        
+        os.makedirs(graph_dir, exist_ok=True)
+        for key, arr in graph.items():
+            np.save(os.path.join(graph_dir, f"{key}.npy"), arr)
+        logger.info(f"Saved road network cache to {graph_dir}")
+
+    def check_contraction(self, samples=20, seed=0):
+        """
+        Compares contracted-graph costs (_search/_node_costs) against Dijkstra on
+        the full penalized graph from random start nodes, for every mode.
+        Returns the number of (start, mode) pairs whose costs disagree.
+        """
+        n = len(self.node_xy)
+        if n == 0:
+            return 0
+        starts = np.random.default_rng(seed).choice(n, min(samples, n), replace=False)
+        mismatches = 0
+        for mode, (penalties, _) in self.MODE_PROFILES.items():
+            full = csr_matrix(((self.w * self._mode_penalty(penalties, self.s)).astype(np.float64), self.indices, self.indptr), shape=(n, n))
+            for start in starts:
+                expected = dijkstra(full, indices=start)
+                cost = self._node_costs(self._search(start, mode), start, np.arange(n), mode)[0]
+                if not np.allclose(cost, expected, rtol=1e-5, atol=1e-3):
+                    logger.warning(f"Contracted costs differ from full graph: start {start}, mode {mode}")
+                    mismatches += 1
+        return mismatches
+
+    def load_graph_cache(self, graph_dir):
+        """
+        Memory-maps CSR arrays saved by build_graph_cache and installs them as the
+        active graph. Read-only mappings let worker processes share the same pages;
+        that includes the per-mode weights and scaled coordinates (see
+        _derived_arrays), so only cKDTree's index stays private per worker.
+        """
+        graph = {
+            name[:-4]: np.load(os.path.join(graph_dir, name), mmap_mode='r')
+            for name in os.listdir(graph_dir) if name.endswith(".npy")
+        }
+        if "c_indptr" not in graph:
+            # Cache written before chain contraction; contract in memory
+            graph = self._contract_chains(graph)
+        self._set_graph(graph, self.FULL_EXTENT)
+        logger.info(f"Loaded road network cache from {graph_dir}: {len(self.node_xy)} nodes")
+
     def _build_regional_graph(self, bbox):
         """
-        Loads roads within a bbox and builds a local network using pyogrio for speed.
-        bbox: (minx, miny, maxx, maxy)
+        Loads roads within a bbox and builds a local CSR network using pyogrio for speed.
+        bbox: (minx, miny, maxx, maxy), or None for the whole road file
+        Returns a dict of CSR arrays (see _to_csr).
         """
         import time
         start_t = time.time()
         try:
             print(f"Loading regional roads for bbox: {bbox}")
             # Buffer the bbox slightly (approx 5km)
-            buffered_bbox = (bbox[0]-0.05, bbox[1]-0.05, bbox[2]+0.05, bbox[3]+0.05)
+            buffered_bbox = (bbox[0]-0.05, bbox[1]-0.05, bbox[2]+0.05, bbox[3]+0.05) if bbox else None
+            
+            # Use pyogrio for significantly faster loads; only the attributes used for safety factors
+            gdf = gpd.read_file(self.road_file, bbox=buffered_bbox, engine="pyogrio", columns=['surface', 'highway'])
             
-            # Use pyogrio if available for significantly faster loads
-            gdf = gpd.read_file(self.road_file, bbox=buffered_bbox, engine="pyogrio")
+            row_safety = self._safety_factors(gdf)
             
-            G = nx.Graph()
-            geoms = gdf.geometry
-            surfaces = gdf.get('surface', ['unknown'] * len(gdf))
-            highways = gdf.get('highway', ['unknown'] * len(gdf))
+            # Split multi-part geometries into lines, then pull every vertex in one call;
+            # part_no tags each vertex with its line and parent with its source row
+            parts, parent = shapely.get_parts(np.asarray(gdf.geometry.values), return_index=True)
+            coords, part_no = shapely.get_coordinates(parts, return_index=True)
             
-            edge_count = 0
-            for geom, surface, highway in zip(geoms, surfaces, highways):
-                if not geom: continue
-                lines = [geom] if geom.geom_type == 'LineString' else list(geom.geoms)
-                for line in lines:
-                    safety_factor = self._get_safety_factor(surface, highway)
-                    coords = [(round(p[0], 6), round(p[1], 6)) for p in line.coords]
-                    for i in range(len(coords) - 1):
-                        G.add_edge(coords[i], coords[i+1], weight=self._haversine(coords[i][0], coords[i][1], coords[i+1][0], coords[i+1][1]), safety_factor=safety_factor)
-                        edge_count += 1
+            # Contiguous int ids for rounded (lon, lat) vertices in one dedup pass
+            if len(coords):
+                node_xy, inv = np.unique(np.round(coords, 6), axis=0, return_inverse=True)
+                inv = inv.ravel().astype(np.int32)
+                
+                # Consecutive vertices on the same line form a segment
+                same_line = part_no[1:] == part_no[:-1]
+                us, vs = inv[:-1][same_line], inv[1:][same_line]
+                safeties = row_safety[parent[part_no[:-1][same_line]]]
+            else:
+                node_xy = np.empty((0, 2))
+                us = vs = np.zeros(0, dtype=np.int32); safeties = np.zeros(0)
             
-            print(f"Regional graph ready in {time.time()-start_t:.2f}s: {len(G.nodes)} nodes, {edge_count} edges")
-            return G
+            # Drop zero-length segments, then measure all segments in one vectorized pass
+            seg = us != vs
+            us, vs, safeties = us[seg], vs[seg], safeties[seg]
+            dists = self._equirect_vec(node_xy[us, 0], node_xy[us, 1], node_xy[vs, 0], node_xy[vs, 1])
+            graph = self._largest_component(self._to_csr(node_xy, us, vs, dists, safeties))
+            graph = self._contract_chains(graph)
+            
+            print(f"Regional graph ready in {time.time()-start_t:.2f}s: {len(graph['node_xy'])} nodes, {len(graph['indices']) // 2} edges, "
+                  f"{int((graph['v_chain'] < 0).sum())} junctions, {len(graph['c_indices']) // 2} search edges")
+            return graph
         except Exception as e:
             print(f"Error building regional graph: {e}")
-            return nx.Graph()
+            return self._contract_chains(self._to_csr(np.empty((0, 2)), [], [], [], []))
+
+    def _to_csr(self, node_xy, us, vs, dists, safeties, chains=None):
+        """
+        Packs undirected edges into CSR arrays:
+        indptr int32[N+1], indices int32[2E], w float32[2E] (meters),
+        s float32[2E] (safety factor), node_xy float64[N,2] (lon, lat).
+        Duplicate edges keep the shortest segment, then the safest, so both
+        directions of a road always agree. Optional per-edge chains
+        (see _contract_chains) ride along as an extra "chain" array.
+        """
+        us = np.asarray(us, dtype=np.int32)
+        vs = np.asarray(vs, dtype=np.int32)
+        dists = np.asarray(dists, dtype=np.float32)
+        safeties = np.asarray(safeties, dtype=np.float32)
+        c = np.zeros(len(us), dtype=np.int32) if chains is None else np.asarray(chains, dtype=np.int32)
+        
+        # Dedup once per undirected (lo, hi) pair, sorted by (lo, hi, length, safety)
+        lo = np.minimum(us, vs); hi = np.maximum(us, vs)
+        order = np.lexsort((c, safeties, dists, hi, lo))
+        lo, hi, w, s, c = lo[order], hi[order], dists[order], safeties[order], c[order]
+        
+        keep = np.ones(len(lo), dtype=bool)
+        keep[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+        lo, hi, w, s, c = lo[keep], hi[keep], w[keep], s[keep], c[keep]
+        
+        # Mirror into both directions, sorted by (source, target)
+        src = np.concatenate([lo, hi]); dst = np.concatenate([hi, lo])
+        w = np.concatenate([w, w]); s = np.concatenate([s, s]); c = np.concatenate([c, c])
+        order = np.lexsort((dst, src))
+        src, dst, w, s, c = src[order], dst[order], w[order], s[order], c[order]
+        
+        indptr = np.zeros(len(node_xy) + 1, dtype=np.int32)
+        indptr[1:] = np.bincount(src, minlength=len(node_xy)).cumsum()
+        graph = {"indptr": indptr, "indices": dst, "w": w, "s": s, "node_xy": node_xy}
+        if chains is not None:
+            graph["chain"] = c
+        return graph
+
+    def _largest_component(self, graph):
+        """
+        Restricts CSR arrays to the largest connected component so every
+        snapped start/clinic node can reach the others.
+        """
+        indptr, indices = graph["indptr"], graph["indices"]
+        n = len(graph["node_xy"])
+        if n == 0:
+            return graph
+        adj = csr_matrix((np.ones(len(indices), dtype=np.int8), indices, indptr), shape=(n, n))
+        _, labels = connected_components(adj, directed=False)
+        keep = labels == np.bincount(labels).argmax()
+        if keep.all():
+            return graph
+        
+        # Old -> new ids are monotonic, so rows stay sorted
+        new_id = (np.cumsum(keep) - 1).astype(np.int32)
+        edge_keep = np.repeat(keep, np.diff(indptr))
+        new_indptr = np.zeros(keep.sum() + 1, dtype=np.int32)
+        new_indptr[1:] = np.diff(indptr)[keep].cumsum()
+        return {
+            "indptr": new_indptr,
+            "indices": new_id[indices[edge_keep]],
+            "w": graph["w"][edge_keep],
+            "s": graph["s"][edge_keep],
+            "node_xy": graph["node_xy"][keep],
+        }
+
+    def _contract_chains(self, graph):
+        """
+        Adds a contracted search graph: each run of degree-2 nodes whose two edges
+        share a safety factor becomes one shortcut edge between the junctions at
+        its ends. The full graph stays for snapping, geometry and metrics.
+        Added arrays:
+        c_indptr, c_indices, c_w, c_s, c_chain - search CSR over the same node ids;
+            c_chain is the chain id of a shortcut, -1 for an original edge
+        chain_ptr, chain_nodes - node ids of each chain, junction to junction
+        chain_len, chain_s - chain length (meters) and safety factor
+        v_chain, v_pos, v_off - per node: chain id (-1 for junctions), index
+            into its chain_nodes and meters from the chain's first node
+        """
+        indptr, indices, w, s = graph["indptr"], graph["indices"], graph["w"], graph["s"]
+        n = len(graph["node_xy"])
+        deg = np.diff(indptr)
+        src = np.repeat(np.arange(n, dtype=np.int32), deg)
+        first = indptr[:-1]
+
+        # Interior nodes: exactly two edges, both with the same safety factor
+        interior = deg == 2
+        interior[interior] = s[first[interior]] == s[first[interior] + 1]
+
+        # Each shortcut must be the only search edge between its junctions, or
+        # _to_csr would keep the shorter one in meters regardless of safety.
+        # Colliding chains turn their first interior node back into a junction.
+        while True:
+            chains = self._trace_chains(graph, interior)
+            chain_ptr, chain_nodes = chains["chain_ptr"], chains["chain_nodes"]
+            a, b = chain_nodes[chain_ptr[:-1]], chain_nodes[chain_ptr[1:] - 1]
+            direct = ~interior[src] & ~interior[indices] & (src < indices)
+            through = np.flatnonzero(a != b)
+            lo = np.concatenate([src[direct], np.minimum(a, b)[through]]).astype(np.int64)
+            hi = np.concatenate([indices[direct], np.maximum(a, b)[through]]).astype(np.int64)
+            _, inv, counts = np.unique(lo * n + hi, return_inverse=True, return_counts=True)
+            clash = through[counts[inv.ravel()[direct.sum():]] > 1]
+            if not len(clash):
+                break
+            interior[chain_nodes[chain_ptr[clash] + 1]] = False
+
+        # Search edges: junction-to-junction originals plus one shortcut per chain
+        # (chains looping back to their own junction only matter for snapping)
+        chain_len, chain_s = chains["chain_len"], chains["chain_s"]
+        search = self._to_csr(
+            graph["node_xy"],
+            np.concatenate([src[direct], a[through]]), np.concatenate([indices[direct], b[through]]),
+            np.concatenate([w[direct], chain_len[through]]), np.concatenate([s[direct], chain_s[through]]),
+            np.concatenate([np.full(direct.sum(), -1), through]))
+
+        return dict(
+            graph,
+            c_indptr=search["indptr"], c_indices=search["indices"],
+            c_w=search["w"], c_s=search["s"], c_chain=search["chain"],
+            chain_ptr=chain_ptr, chain_nodes=chain_nodes,
+            chain_len=chain_len, chain_s=chain_s,
+            v_chain=chains["v_chain"], v_pos=chains["v_pos"], v_off=chains["v_off"],
+        )
+
+    def _trace_chains(self, graph, interior):
+        """
+        Groups interior nodes (bool mask, see _contract_chains) into chains running
+        junction to junction. Rings with no junction have one node cleared from
+        interior in place. Returns the chain_* and v_* arrays of _contract_chains.
+        """
+        indptr, indices, w, s = graph["indptr"], graph["indices"], graph["w"], graph["s"]
+        n = len(graph["node_xy"])
+        src = np.repeat(np.arange(n, dtype=np.int32), np.diff(indptr))
+        first = indptr[:-1]
+
+        # Chains are the components of the subgraph induced by interior nodes;
+        # a ring with no junction on it keeps one node so every chain has ends
+        while True:
+            inner = interior[src] & interior[indices]
+            sub = csr_matrix((np.ones(inner.sum(), dtype=np.int8), (src[inner], indices[inner])), shape=(n, n))
+            _, labels = connected_components(sub, directed=False)
+            is_end = interior & (np.bincount(src[inner], minlength=n) < 2)
+            rings = np.setdiff1d(labels[interior], labels[is_end])
+            if not len(rings):
+                break
+            ring_nodes = np.flatnonzero(interior & np.isin(labels, rings))
+            _, pick = np.unique(labels[ring_nodes], return_index=True)
+            interior[ring_nodes[pick]] = False
+
+        rem = np.flatnonzero(interior)
+        _, chain_of = np.unique(labels[rem], return_inverse=True)
+        chain_of = chain_of.ravel().astype(np.int32)
+        n_chain = int(chain_of.max()) + 1 if len(rem) else 0
+        v_chain = np.full(n, -1, dtype=np.int32)
+        v_chain[rem] = chain_of
+
+        # Root each chain at one end node x next to junction a; distances from a
+        # virtual node n wired to every x give offsets along each chain
+        ends = np.flatnonzero(is_end)
+        _, pick = np.unique(v_chain[ends], return_index=True)
+        x = ends[pick]
+        k = first[x]
+        a_first = ~interior[indices[k]]
+        a = np.where(a_first, indices[k], indices[k + 1])
+        wa = np.where(a_first, w[k], w[k + 1])
+        rooted = csr_matrix(
+            (np.concatenate([w[inner], wa]).astype(np.float64),
+             (np.concatenate([src[inner], np.full(n_chain, n)]), np.concatenate([indices[inner], x]))),
+            shape=(n + 1, n + 1))
+        off = dijkstra(rooted, indices=n)[:n] if n_chain else np.zeros(n)
+
+        # Order interior nodes along their chain; junction b sits past the last node y
+        order = np.lexsort((off[rem], chain_of))
+        rem, chain_of = rem[order], chain_of[order]
+        counts = np.bincount(chain_of, minlength=n_chain)
+        last = np.cumsum(counts) - 1
+        y = rem[last]
+        prev = np.where(counts > 1, rem[np.maximum(last - 1, 0)], a)
+        k = first[y]
+        b_first = indices[k] != prev
+        b = np.where(b_first, indices[k], indices[k + 1])
+        chain_len = (off[y] + np.where(b_first, w[k], w[k + 1])).astype(np.float32)
+        chain_s = s[first[x]]
+
+        chain_ptr = np.zeros(n_chain + 1, dtype=np.int32)
+        chain_ptr[1:] = np.cumsum(counts + 2)
+        chain_nodes = np.empty(chain_ptr[-1], dtype=np.int32)
+        chain_nodes[chain_ptr[:-1]] = a
+        chain_nodes[chain_ptr[1:] - 1] = b
+        v_pos = np.zeros(n, dtype=np.int32)
+        v_pos[rem] = np.arange(len(rem)) - np.repeat(last + 1 - counts, counts) + 1
+        chain_nodes[chain_ptr[chain_of] + v_pos[rem]] = rem
+
+        return {
+            "chain_ptr": chain_ptr, "chain_nodes": chain_nodes,
+            "chain_len": chain_len, "chain_s": chain_s,
+            "v_chain": v_chain, "v_pos": v_pos, "v_off": np.where(interior, off, 0).astype(np.float32),
+        }
+
+    def _derived_arrays(self, graph):
+        """
+        Query-time arrays computed from a contracted graph, keyed like graph arrays
+        so build_graph_cache can save them for workers to memory-map:
+        cost_<mode> float64 - penalized c_w, the data of csr_by_mode[mode]
+        chain_pen_<mode> float64 - surface-tier penalty per chain
+        edge_id int32 - data of csr_edge
+        lon_scale float64 0-d, node_xy_scaled float64[N,2] - cKDTree input
+        Saved costs bake in MODE_PROFILES penalties; rebuild the cache after changing them.
+        """
+        derived = {}
+        for mode, (penalties, _) in self.MODE_PROFILES.items():
+            derived[f"cost_{mode}"] = (graph["c_w"] * self._mode_penalty(penalties, graph["c_s"])).astype(np.float64)
+            derived[f"chain_pen_{mode}"] = self._mode_penalty(penalties, graph["chain_s"]).astype(np.float64)
+        derived["edge_id"] = np.arange(len(graph["indices"]), dtype=np.int32)
+        
+        # Shrink longitude by cos(mean lat) so Euclidean distance in the tree is ~metric
+        node_xy = graph["node_xy"]
+        lon_scale = math.cos(math.radians(float(node_xy[:, 1].mean()))) if len(node_xy) else 1.0
+        derived["lon_scale"] = np.array(lon_scale)
+        derived["node_xy_scaled"] = np.column_stack([node_xy[:, 0] * lon_scale, node_xy[:, 1]])
+        return derived
+
+    def _set_graph(self, graph, bbox):
+        """
+        Installs CSR arrays as the active regional graph, deriving query-time
+        arrays (see _derived_arrays) unless the graph already carries them.
+        """
+        if any(f"cost_{mode}" not in graph for mode in self.MODE_PROFILES):
+            graph = dict(graph, **self._derived_arrays(graph))
+        self.indptr = graph["indptr"]
+        self.indices = graph["indices"]
+        self.w = graph["w"]
+        self.s = graph["s"]
+        self.node_xy = graph["node_xy"]
+        self.chain_ptr = graph["chain_ptr"]
+        self.chain_nodes = graph["chain_nodes"]
+        self.chain_len = graph["chain_len"]
+        self.v_chain = graph["v_chain"]
+        self.v_pos = graph["v_pos"]
+        self.v_off = graph["v_off"]
+        self.current_bbox = bbox
+        
+        # One weighted matrix per mode over the contracted graph so queries need no
+        # weight callback; chain penalties price partial chains. csr_matrix and
+        # cKDTree wrap the arrays as-is, so memory-mapped ones stay shared.
+        n = len(self.node_xy)
+        c_indptr, c_indices = graph["c_indptr"], graph["c_indices"]
+        def as_csr(data):
+            return csr_matrix((data, c_indices, c_indptr), shape=(n, n))
+        self.csr_by_mode = {mode: as_csr(graph[f"cost_{mode}"]) for mode in self.MODE_PROFILES}
+        self.chain_pen_by_mode = {mode: graph[f"chain_pen_{mode}"] for mode in self.MODE_PROFILES}
+        self.csr_chain = as_csr(graph["c_chain"])
+        self.csr_edge = csr_matrix((graph["edge_id"], self.indices, self.indptr), shape=(n, n))
+        self.lon_scale = float(graph["lon_scale"])
+        self.kdtree = cKDTree(graph["node_xy_scaled"]) if n else None
+        
+        # Snap every clinic to the new graph in one batched query
+        if self.kdtree is not None and self.clinic_xy is not None and len(self.clinic_xy):
+            self.clinic_node = self.kdtree.query(self._scale_xy(self.clinic_xy), workers=-1)[1]
+        else:
+            self.clinic_node = None
+
+    def _mode_penalty(self, penalties, s):
+        """
+        Maps safety factors s to their surface-tier penalties.
+        """
+        return np.where(s <= 1.0, penalties["smooth"],
+               np.where(s <= 1.15, penalties["moderate"],
+               np.where(s <= 1.5, penalties["rough"], penalties["avoid"])))
+
+    def find_nearest_node(self, lat, lon):
+        """
+        Returns the int id of the graph node closest to (lat, lon).
+        """
+        _, idx = self.kdtree.query([lon * self.lon_scale, lat])
+        return int(idx)
+
+    def _scale_xy(self, xy):
+        """
+        Returns a copy of (lon, lat) rows with lon multiplied by lon_scale.
+        """
+        xy = np.array(xy, dtype=np.float64)
+        xy[:, 0] *= self.lon_scale
+        return xy
+
+    def _walk_path(self, pred, dst):
+        """
+        Reconstructs the node id path ending at dst from a predecessor array.
+        """
+        path = [dst]
+        while pred[path[-1]] >= 0:
+            path.append(int(pred[path[-1]]))
+        return path[::-1]
+
+    def _chain(self, c):
+        """
+        Node ids of chain c, from its first junction to its last.
+        """
+        return self.chain_nodes[self.chain_ptr[c]:self.chain_ptr[c + 1]]
+
+    def _search(self, start, profile, limit=np.inf):
+        """
+        Dijkstra over the contracted graph from node start; a start inside a chain
+        searches from both of the chain's junctions. Returns (sources, offsets,
+        cost, pred) with one row per source, offsets being start -> source cost.
+        """
+        c = self.v_chain[start]
+        if c < 0:
+            sources, offsets = [start], np.zeros(1)
+        else:
+            chain = self._chain(c)
+            sources = [int(chain[0]), int(chain[-1])]
+            along = float(self.v_off[start])
+            offsets = np.array([along, float(self.chain_len[c]) - along]) * self.chain_pen_by_mode[profile][c]
+        cost, pred = dijkstra(self.csr_by_mode[profile], indices=sources, return_predecessors=True, limit=limit)
+        return sources, offsets, cost, pred
+
+    def _node_costs(self, search, start, nodes, profile):
+        """
+        Road cost from start to each of nodes for a _search result, entering a
+        node inside a chain from either junction. Returns (cost, row, end): the
+        search row and chain end (0 first, 1 last) of each best route; row -1
+        means the node lies along the start's own chain.
+        """
+        _, offsets, cost, _ = search
+        nodes = np.asarray(nodes, dtype=np.int64)
+        ends = np.column_stack([nodes, nodes])
+        end_cost = np.zeros((len(nodes), 2))
+        end_cost[:, 1] = np.inf
+        c = self.v_chain[nodes]
+        inside = c >= 0
+        if inside.any():
+            ci = c[inside]
+            ends[inside, 0] = self.chain_nodes[self.chain_ptr[ci]]
+            ends[inside, 1] = self.chain_nodes[self.chain_ptr[ci + 1] - 1]
+            along = self.v_off[nodes[inside]]
+            pen = self.chain_pen_by_mode[profile][ci]
+            end_cost[inside, 0] = along * pen
+            end_cost[inside, 1] = (self.chain_len[ci] - along) * pen
+
+        # total[node, row, end], then the cheapest (row, end) per node
+        total = (offsets[:, None, None] + cost[:, ends] + end_cost[None]).transpose(1, 0, 2).reshape(len(nodes), 2 * len(offsets))
+        best = total.argmin(axis=1)
+        node_cost = total[np.arange(len(nodes)), best]
+        row, end = best // 2, best % 2
+
+        sc = self.v_chain[start]
+        if sc >= 0:
+            same = np.flatnonzero(c == sc)
+            along = np.abs(self.v_off[nodes[same]] - self.v_off[start]) * self.chain_pen_by_mode[profile][sc]
+            closer = along < node_cost[same]
+            node_cost[same[closer]] = along[closer]
+            row[same[closer]] = -1
+        return node_cost, row, end
+
+    def _node_path(self, search, start, node, row, end):
+        """
+        Node id path from start to node for a (row, end) choice of _node_costs,
+        with shortcut edges expanded back into their chain nodes.
+        """
+        sources, _, _, pred = search
+        sc = self.v_chain[start]
+        if row < 0:
+            chain, i, j = self._chain(sc), self.v_pos[start], self.v_pos[node]
+            return (chain[i:j + 1] if i <= j else chain[j:i + 1][::-1]).tolist()
+
+        # start -> the junction this search row began at
+        head = []
+        if sc >= 0:
+            chain, i = self._chain(sc), self.v_pos[start]
+            head = (chain[:i + 1][::-1] if row == 0 else chain[i:])[:-1].tolist()
+
+        # the junction the route enters node's chain from -> node
+        tail = []
+        nc = self.v_chain[node]
+        if nc >= 0:
+            chain, j = self._chain(nc), self.v_pos[node]
+            tail = (chain[:j + 1] if end == 0 else chain[j:][::-1]).tolist()
+            node = tail.pop(0)
+
+        hops = self._walk_path(pred[row], node)
+        path = hops[:1]
+        chains = np.asarray(self.csr_chain[hops[:-1], hops[1:]]).ravel() if len(hops) > 1 else []
+        for u, v, c in zip(hops[:-1], hops[1:], chains):
+            if c < 0:
+                path.append(v)
+            else:
+                chain = self._chain(c)
+                path.extend((chain if chain[0] == u else chain[::-1])[1:].tolist())
+        return head + path + tail
+
+    def _safety_factors(self, gdf):
+        """
+        Per-row safety factors for a roads GeoDataFrame. _get_safety_factor runs
+        once per distinct (surface, highway) pair and is broadcast back to rows.
+        """
+        surfaces = gdf['surface'] if 'surface' in gdf else pd.Series('unknown', index=gdf.index)
+        highways = gdf['highway'] if 'highway' in gdf else pd.Series('unknown', index=gdf.index)
+        pairs = pd.MultiIndex.from_arrays([surfaces.astype(str).str.lower(), highways.astype(str).str.lower()])
+        codes, uniques = pairs.factorize()
+        table = np.array([self._get_safety_factor(surface, highway) for surface, highway in uniques], dtype=np.float32)
+        return table[codes]
 
     def _get_safety_factor(self, surface, highway):
         """
@@ -158,15 +705,29 @@ class SafeRouter:
         return geom.length # This is in degrees if CRS is 4326, which is not meters.
         # We handle segment length in _build_graph using haversine for weight
 
-    def _haversine(self, lon1, lat1, lon2, lat2):
-        R = 6371000  # meters
-        phi1, phi2 = math.radians(lat1), math.radians(lat2)
-        dphi = math.radians(lat2 - lat1)
-        dlambda = math.radians(lon2 - lon1)
-        a = math.sin(dphi/2)**2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda/2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    def _haversine_vec(self, lon1, lat1, lon2, lat2):
+        """
+        Great-circle distance in meters; arguments may be scalars or NumPy arrays.
+        """
+        R = self.EARTH_RADIUS
+        phi1, phi2 = np.radians(lat1), np.radians(lat2)
+        dphi = np.radians(lat2 - lat1)
+        dlambda = np.radians(lon2 - lon1)
+        a = np.sin(dphi/2)**2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda/2)**2
+        # arcsin form: same result as atan2(sqrt(a), sqrt(1-a)) with one sqrt fewer
+        c = 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
         return R * c
 
+    def _equirect_vec(self, lon1, lat1, lon2, lat2):
+        """
+        Equirectangular distance in meters for short road segments; within 0.1% of
+        _haversine_vec at segment lengths, with one cos instead of several trig calls.
+        """
+        R = self.EARTH_RADIUS
+        x = np.cos(np.radians(0.5 * (lat1 + lat2))) * np.radians(lon2 - lon1)
+        y = np.radians(lat2 - lat1)
+        return R * np.hypot(x, y)
+
     def get_safest_route(self, start_lat, start_lon, week, mode):
         """
         Finds the top 3 safest/best hospitals using regional lazy loading.
@@ -177,88 +738,118 @@ class SafeRouter:
         # 1. Selection & Mode Logic
         mode = mode.lower() if mode else "routine"
         if mode == "emergency":
-            penalties = {"smooth": 1.0, "moderate": 1.1, "rough": 1.3, "avoid": 2.5}
-            max_dist = 10000 
+            profile = "emergency"
         elif mode == "high_risk" or (week and int(week) >= 28):
-            penalties = {"smooth": 1.0, "moderate": 1.2, "rough": 1.6, "avoid": 3.5}
-            max_dist = 20000 
+            profile = "high_risk"
         else:
-            penalties = {"smooth": 1.0, "moderate": 1.15, "rough": 1.4, "avoid": 3.0}
-            max_dist = 50000 
-            
-        def weight_func(u, v, d):
-            safety = d.get('safety_factor', 1.2)
-            p = penalties["smooth"] if safety <= 1.0 else (penalties["moderate"] if safety <= 1.15 else (penalties["rough"] if safety <= 1.5 else penalties["avoid"]))
-            return d.get('weight', 1.0) * p
+            profile = "routine"
+        
+        # Nearby repeat requests (e.g. an idle phone re-polling) are served from cache.
+        # Failures raise instead of returning, so lru_cache does not keep them and a
+        # transient road-file error is retried on the next request.
+        decimals = self.ROUTE_CACHE_DECIMALS
+        try:
+            return self._route_cached(round(start_lat, decimals), round(start_lon, decimals), profile)
+        except NoRouteError as e:
+            logger.warning(f"No route: {e}")
+            return None
 
+    def route_cache_info(self):
+        """
+        Hit/miss statistics of the route result cache.
+        """
+        return self._route_cached.cache_info()
+
+    def _compute_route(self, start_lat, start_lon, profile):
+        """
+        Uncached body of get_safest_route for a resolved mode profile.
+        Raises NoRouteError instead of returning an empty result.
+        """
+        penalties, max_dist = self.MODE_PROFILES[profile]
+            
         # 2. Candidate Filtering
-        candidates = []
-        for idx, row in self.clinics_gdf.iterrows():
-            c = row.geometry if row.geometry.geom_type == 'Point' else row.geometry.centroid
-            d_s = self._haversine(start_lat, start_lon, c.y, c.x)
-            if d_s <= max_dist:
-                is_hosp = 1 if row.get('amenity') == 'hospital' else 0
-                # Store (is_hospital, distance, idx, lat, lon)
-                candidates.append((is_hosp, d_s, idx, c.y, c.x))
+        # Degree radius covering max_dist along the (shorter) longitude axis at the most
+        # poleward latitude in reach, then exact haversine
+        far_lat = min(abs(start_lat) + max_dist / self.METERS_PER_DEGREE, 89.0)
+        radius = max_dist / (self.METERS_PER_DEGREE * math.cos(math.radians(far_lat)))
+        near = np.sort(np.asarray(self.clinic_tree.query_ball_point([start_lon, start_lat], r=radius), dtype=np.int64))
+        d_s = self._haversine_vec(start_lon, start_lat, self.clinic_xy[near, 0], self.clinic_xy[near, 1])
+        near, d_s = near[d_s <= max_dist], d_s[d_s <= max_dist]
         
-        # Sort by hospital priority first, then distance
-        candidates.sort(key=lambda x: (-x[0], x[1]))
-        candidates = candidates[:8] # Eval top 8 (prioritizing hospitals)
+        # Sort by hospital priority first, then distance; these seeds size the search region
+        order = np.lexsort((d_s, ~self.clinic_is_hosp[near]))[:8] # Top 8 (prioritizing hospitals)
+        seeds, seed_dist = near[order], d_s[order]
         
-        if not candidates: return None
+        if not len(seeds):
+            raise NoRouteError("no clinics within range")
 
         # 3. Dynamic BBox Loading
-        all_lats = [start_lat] + [c[3] for c in candidates]
-        all_lons = [start_lon] + [c[4] for c in candidates]
+        all_lats = np.append(self.clinic_xy[seeds, 1], start_lat)
+        all_lons = np.append(self.clinic_xy[seeds, 0], start_lon)
         # Shrink bbox logic: only buffer slightly (approx 1km)
-        bbox = (min(all_lons)-0.01, min(all_lats)-0.01, max(all_lons)+0.01, max(all_lats)+0.01)
+        bbox = (float(all_lons.min())-0.01, float(all_lats.min())-0.01, float(all_lons.max())+0.01, float(all_lats.max())+0.01)
         
         # Regional Caching
-        if self.G and self.current_bbox:
+        if self.node_xy is not None and len(self.node_xy) and self.current_bbox:
             # If new bbox is inside cached bbox, reuse
             if (bbox[0] >= self.current_bbox[0] and bbox[1] >= self.current_bbox[1] and 
                 bbox[2] <= self.current_bbox[2] and bbox[3] <= self.current_bbox[3]):
                 logger.info("Reusing cached regional graph.")
-                G_reg = self.G
             else:
-                G_reg = self._build_regional_graph(bbox)
-                self.G = G_reg
-                self.current_bbox = bbox
+                self._set_graph(self._build_regional_graph(bbox), bbox)
         else:
-            G_reg = self._build_regional_graph(bbox)
-            self.G = G_reg
-            self.current_bbox = bbox
+            self._set_graph(self._build_regional_graph(bbox), bbox)
 
-        if not G_reg or len(G_reg.nodes) == 0: 
-            logger.warning("No roads found in regional search area.")
-            return None
+        if len(self.node_xy) == 0: 
+            raise NoRouteError("no roads found in regional search area")
         
-        # Optimize nearest node search
-        node_list = list(G_reg.nodes)
-        def find_fast(lat, lon):
-            return min(node_list, key=lambda n: (n[1]-lat)**2 + (n[0]-lon)**2)
-
-        start_node = find_fast(start_lat, start_lon)
+        start_node = self.find_nearest_node(start_lat, start_lon)
+        
+        end_nodes = self.clinic_node[seeds]
+        
+        # Single-source search covers every candidate in one pass. Bound it to a
+        # generous detour around the farthest seed so a nationwide graph is
+        # not fully expanded; rerun unbounded if any seed lies beyond it.
+        limit = float(seed_dist.max()) * penalties["avoid"] * self.SEARCH_DETOUR_FACTOR
+        search = self._search(start_node, profile, limit)
+        if np.isinf(self._node_costs(search, start_node, end_nodes, profile)[0]).any():
+            search = self._search(start_node, profile)
+        
+        # 4. Re-rank by road cost: every in-range clinic inside the region competes,
+        # so a clinic that is close as the crow flies but far by road (e.g. across a
+        # ridge) no longer crowds out one that is quicker to reach
+        x, y = self.clinic_xy[near, 0], self.clinic_xy[near, 1]
+        in_region = (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+        road_cost, rows, ends = self._node_costs(search, start_node, self.clinic_node[near], profile)
+        reached = in_region & np.isfinite(road_cost)
+        near, d_s, road_cost, rows, ends = near[reached], d_s[reached], road_cost[reached], rows[reached], ends[reached]
+        order = np.lexsort((road_cost, ~self.clinic_is_hosp[near]))[:8] # Eval top 8 (prioritizing hospitals)
+        # Store (clinic position, distance, idx, lat, lon)
+        candidates = [
+            (int(near[o]), float(d_s[o]), self.clinic_idx[near[o]], float(self.clinic_xy[near[o], 1]), float(self.clinic_xy[near[o], 0]))
+            for o in order
+        ]
+        end_nodes = self.clinic_node[[c[0] for c in candidates]]
+        routes = [(road_cost[o], rows[o], ends[o]) for o in order]
         
         results = []
-        for is_hosp, dist_s, clinic_idx, t_lat, t_lon in candidates:
-            # Use the optimized search
-            end_node = find_fast(t_lat, t_lon)
-            
+        for (pos, dist_s, clinic_idx, t_lat, t_lon), end_node, (node_cost, row, end) in zip(candidates, end_nodes, routes):
             try:
-                def heuristic(u, v): return self._haversine(u[1], u[0], v[1], v[0])
-                path = nx.astar_path(G_reg, start_node, end_node, heuristic, weight_func)
+                if np.isinf(node_cost):
+                    raise ValueError(f"No path to node {end_node}")
+                path = self._node_path(search, start_node, end_node, row, end)
                 
                 # Metrics
-                total_dist = 0; roughness_sum = 0; travel_time = 0; path_segments = []
-                for i in range(len(path) - 1):
-                    u, v = path[i], path[i+1]
-                    d = G_reg.get_edge_data(u, v)
-                    dist = d.get('weight', 0); s = d.get('safety_factor', 1.0)
-                    total_dist += dist; roughness_sum += (s - 1.0) * dist
-                    speed = 40 if s <= 1.0 else (25 if s <= 1.15 else (15 if s <= 1.5 else 5))
-                    travel_time += (dist / (speed * 1000 / 60))
-                    path_segments.append({"coords": [u, v], "safety": s})
+                u_ids, v_ids = path[:-1], path[1:]
+                if u_ids:
+                    edge_ids = np.asarray(self.csr_edge[u_ids, v_ids]).ravel()
+                    dists = self.w[edge_ids].astype(np.float64); sfs = self.s[edge_ids].astype(np.float64)
+                else:
+                    dists = sfs = np.zeros(0)
+                total_dist = float(dists.sum())
+                roughness_sum = float(((sfs - 1.0) * dists).sum())
+                speed = np.where(sfs <= 1.0, 40, np.where(sfs <= 1.15, 25, np.where(sfs <= 1.5, 15, 5)))
+                travel_time = float((dists / (speed * 1000 / 60)).sum())
 
                 avg_roughness = (roughness_sum / total_dist) if total_dist > 0 else 0
                 dist_penalty = (total_dist / 1000) * 1.5   # Reduced from 2.0
@@ -273,7 +864,8 @@ class SafeRouter:
                     "distance_meters": total_dist, 
                     "time_minutes": travel_time,
                     "avg_safety_factor": round(1.0 + avg_roughness, 2), 
-                    "route_segments": path_segments,
+                    "path": path,
+                    "segment_safety": sfs,
                     "clinic_idx": clinic_idx, 
                     "lat": t_lat, 
                     "lon": t_lon
@@ -297,17 +889,22 @@ class SafeRouter:
                 if len(dedup_results) >= 3:
                     break
         
-        from shapely.geometry import LineString
         for name, res in dedup_results.items():
             clinic_row = self.clinics_gdf.loc[res['clinic_idx']]
             
-            # Reconstruct GeoJSON with safety levels for segments
-            segments_geojson = []
-            for seg in res['route_segments']:
-                segments_geojson.append({
-                    "geometry": LineString(seg['coords']).__geo_interface__,
-                    "properties": {"safety": round(seg['safety'], 2)}
-                })
+            # Emit GeoJSON with safety levels straight from node coordinates, merging
+            # consecutive hops of equal safety into one polyline
+            coords = self.node_xy[res['path']].tolist()
+            safety = np.round(res['segment_safety'], 2)
+            starts = np.flatnonzero(np.diff(safety, prepend=np.nan))
+            ends = np.append(starts[1:], len(safety))
+            segments_geojson = [
+                {
+                    "geometry": {"type": "LineString", "coordinates": coords[a:b+1]},
+                    "properties": {"safety": float(safety[a])}
+                }
+                for a, b in zip(starts, ends)
+            ]
 
             top_results.append({
                 "score": res['score'],
@@ -322,4 +919,6 @@ class SafeRouter:
                 }
             })
             
+        if not top_results:
+            raise NoRouteError("no candidate clinic could be routed")
         return top_results